@@ -1,15 +1,32 @@
 # ----- IMPORTS -----
 import os
+import sys
+import re
+import json
+import shutil
+import time
+import threading
+import functools
+import inspect
+import hashlib
 import zipfile
 import io
+from concurrent.futures import Future
+import numpy as np
 import pandas as pd
 import requests
 import dash
 import plotly.graph_objects as go
 from dash import Dash, dcc, html, callback
 import plotly.express as px
+import plotly.io as pio
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
+from flask import Response, abort, jsonify, request
+try:
+    import pyarrow as pa  # listed in requirements.txt, Arrow exports return 501 without it
+except ImportError:
+    pa = None
 
 # ----- CUSTOM THEME ------
 color_scheme = {
@@ -62,6 +79,9 @@ pop.loc[pop['RACE_ETHNICITY'] == 'Hispanic', 'RACE_ETHNICITY'] = 'hispanic'
 pop.loc[pop['RACE_ETHNICITY'] == 'White (NH)', 'RACE_ETHNICITY'] = 'white'
 pop.loc[pop['RACE_ETHNICITY'] == 'Multiracial (NH)', 'RACE_ETHNICITY'] = 'other'
 pop_aggregated = pop.groupby('RACE_ETHNICITY').agg({'COUNT_': 'sum'}).reset_index()
+
+# Identifies the loaded data, so cached callback results are never reused across different datasets.
+dataset_version = f"{filename}:{len(raw_phil)}:{raw_phil['date'].max():%Y-%m-%d}"
 '''========================================================================================='''
 
 ''' ---- CREATING CARDS FOR MAIN PAGE ---- '''
@@ -454,10 +474,62 @@ saf_fig.for_each_annotation(lambda a: a.update(text=a.text.split('=')[1], font=d
 '''========================================================================================='''
 
 
+''' ---- CALLBACK REQUEST COALESCING ----- '''
+# When a shared link brings in many sessions at once, they all fire the same callbacks with the same inputs.
+# Concurrent identical calls wait on a single in-flight computation, and its result is kept for a few seconds.
+class CallbackCoalescer:
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.results = {}
+        self.stats = {'computed': 0, 'coalesced': 0, 'cached': 0}
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__, dataset_version, args)
+            with self.lock:
+                expires, result = self.results.get(key, (0, None))
+                if expires > time.monotonic():
+                    self.stats['cached'] += 1
+                    return result
+                future = self.in_flight.get(key)
+                leader = future is None
+                if leader:
+                    future = self.in_flight[key] = Future()
+                    self.stats['computed'] += 1
+                else:
+                    self.stats['coalesced'] += 1
+            if not leader:
+                return future.result()
+
+            try:
+                result = func(*args)
+            except BaseException as e:
+                with self.lock:
+                    del self.in_flight[key]
+                future.set_exception(e)
+                raise
+            with self.lock:
+                del self.in_flight[key]
+                now = time.monotonic()
+                self.results = {k: v for k, v in self.results.items() if v[0] > now}
+                self.results[key] = (now + self.ttl, result)
+            future.set_result(result)
+            return result
+        return wrapper
+
+coalesce = CallbackCoalescer()
+'''========================================================================================'''
+
+
 ''' ---- MAIN DASH APP ----- '''
+# The static export cannot lazy-load component chunks, so every script is put in the page up front.
+exporting = sys.argv[1:2] == ['export']
 app =dash.Dash( __name__, title='Policing the Police',  meta_tags=[
         {"name": "viewport", "content": "width=device-width, initial-scale=1"}
-    ], external_stylesheets=[dbc.themes.BOOTSTRAP])
+    ], external_stylesheets=[dbc.themes.BOOTSTRAP], eager_loading=exporting)
 server = app.server
 app.layout = dbc.Container(children=[
      dcc.Tabs(id='tabs', className='tabs mb-0', value='tab-1', children=[
@@ -644,6 +716,7 @@ app.layout = dbc.Container(children=[
         [Input('year-dropdown', 'value')]
 
 )
+@coalesce
 def update_stats(selected_year):
     if selected_year == 'All':
         # Compute metrics for all years
@@ -664,6 +737,7 @@ def update_stats(selected_year):
     Output('funnel-chart', 'figure'),
     [Input('race-dropdown', 'value')]
 )
+@coalesce
 def update_charts(selected_race):
     race_data = filtered_data_race[filtered_data_race['subject_race'] == selected_race]
     total_stops = len(race_data)
@@ -697,6 +771,7 @@ def update_charts(selected_race):
     Output('donut-chart', 'figure'),
     [Input('chart-dropdown', 'value')]
 )
+@coalesce
 def update_donut(selected_value):
     if selected_value == 'search':
         return fig_search
@@ -707,7 +782,209 @@ def update_donut(selected_value):
     elif selected_value == 'arrest':
         return fig_arrest
 
+@server.route('/_callback-stats')
+def callback_stats():
+    return jsonify(coalesce.stats)
+
+
+''' ---- DATA API ----- '''
+# Serves the numbers behind the charts straight from the data already loaded for the dashboard.
+# Raw stops are streamed in chunks so memory stays flat however large the export is.
+aggregates = {'merged_data': merged_data, 'outcome_test_data': outcome_test_data, 'saf': saf}
+stop_outcomes = ['search_conducted', 'frisk_performed', 'arrest_made', 'contraband_found']
+export_chunk_rows = 50000
+
+def api_error(status, message):
+    # Errors are sent as JSON like the rest of the API, and raised so helpers can reject a request too
+    response = jsonify(error=message)
+    response.status_code = status
+    abort(response)
+
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if not (value.isascii() and value.isdigit()):
+        api_error(400, f'{name} must be a non-negative integer')
+    return int(value)
+
+def page_args():
+    return int_arg('offset', 0), int_arg('limit')
+
+def page_bounds(total, offset, limit):
+    stop = total if limit is None else min(offset + limit, total)
+    return min(offset, total), stop
+
+def api_etag():
+    # The data only changes with the dataset, so the ETag is derived from its version and the query
+    return hashlib.sha1(f"{dataset_version}|{request.full_path}".encode()).hexdigest()
+
+def conditional(response):
+    response.set_etag(api_etag())
+    if response.is_streamed:
+        return response.make_conditional(request)
+    return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+
+@server.route('/api/aggregates')
+def aggregate_index():
+    return conditional(jsonify({name: len(data) for name, data in aggregates.items()}))
+
+@server.route('/api/aggregates/<name>')
+def aggregate_records(name):
+    if name not in aggregates:
+        api_error(404, f"Unknown aggregate, expected one of {', '.join(aggregates)}")
+    data = aggregates[name]
+    start, stop = page_bounds(len(data), *page_args())
+    records = json.loads(data.iloc[start:stop].to_json(orient='records', date_format='iso'))
+    return conditional(jsonify(total=len(data), offset=start, records=records))
+
+def stops_csv(rows):
+    # An empty selection still sends the header row
+    for start in range(0, max(len(rows), 1), export_chunk_rows):
+        yield clean_phil.iloc[rows[start:start + export_chunk_rows]].to_csv(index=False, header=start == 0)
+
+@functools.lru_cache(maxsize=None)
+def stops_schema():
+    return pa.Schema.from_pandas(clean_phil, preserve_index=False)
+
+def stops_arrow(rows):
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, stops_schema()) as writer:
+        for start in range(0, len(rows), export_chunk_rows):
+            chunk = clean_phil.iloc[rows[start:start + export_chunk_rows]]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=stops_schema(), preserve_index=False))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+@server.route('/api/stops')
+def stops_export():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ['csv', 'arrow']:
+        api_error(400, 'format must be csv or arrow')
+    if export_format == 'arrow' and pa is None:
+        api_error(501, 'Arrow export needs pyarrow to be installed')
+    year = int_arg('year')
+    race = request.args.get('race')
+    outcome = request.args.get('outcome')
+    if outcome and outcome not in stop_outcomes:
+        api_error(400, f"outcome must be one of {', '.join(stop_outcomes)}")
+    offset, limit = page_args()
+
+    # A client that already has this export is answered before the table is scanned
+    if api_etag() in request.if_none_match:
+        return conditional(Response())
+
+    mask = np.ones(len(clean_phil), dtype=bool)
+    if year is not None:
+        mask &= (clean_phil['year'] == year).to_numpy()
+    if race:
+        mask &= (clean_phil['subject_race'] == race.lower()).to_numpy()
+    if outcome:
+        mask &= clean_phil[outcome].fillna(False).astype(bool).to_numpy()
+
+    rows = np.flatnonzero(mask)
+    start, stop = page_bounds(len(rows), offset, limit)
+    if export_format == 'csv':
+        response = Response(stops_csv(rows[start:stop]), mimetype='text/csv')
+    else:
+        response = Response(stops_arrow(rows[start:stop]), mimetype='application/vnd.apache.arrow.stream')
+    response.headers['X-Total-Count'] = len(rows)
+    response.headers['Content-Disposition'] = f'attachment; filename=stops.{export_format}'
+    return conditional(response)
+'''========================================================================================'''
+
+
+''' ---- STATIC SNAPSHOT EXPORT ----- '''
+# Writes the dashboard to a folder that any static file host can serve without a Python process.
+# Every callback output is precomputed for each dropdown value and looked up in the browser instead.
+snapshot_namespace = 'snapshot'
+
+# Static hosts only send JSON content types for .json files, so the renderer's requests are redirected to them.
+snapshot_fetch_shim = """<script>
+(function() {
+    var fetch = window.fetch;
+    window.fetch = function(url, options) {
+        if (typeof url === 'string' && /_dash-(layout|dependencies)$/.test(url)) {
+            url += '.json';
+        }
+        return fetch.call(this, url, options);
+    };
+})();
+</script>
+<script src="/snapshot.js"></script>"""
+
+snapshot_lookup_template = """(function() {
+    var outputs = %s;
+    var clientside = window.dash_clientside = window.dash_clientside || {};
+    var lookups = clientside['%s'] = {};
+    Object.keys(outputs).forEach(function(name) {
+        lookups[name] = function(value) {
+            var key = JSON.stringify(value === undefined ? null : value);
+            return key in outputs[name] ? outputs[name][key] : window.dash_clientside.no_update;
+        };
+    });
+})();
+"""
+
+def precompute_callback_outputs():
+    outputs = {}
+    for entry in app.callback_map.values():
+        # Every callback here is driven by a single dropdown, which may also be cleared to None
+        dropdown = app.layout[entry['inputs'][0]['id']]
+        # Unwrapped past the coalescer too, so exporting doesn't touch the live request stats
+        func = inspect.unwrap(entry['callback'])
+        values = [None] + [option['value'] for option in dropdown.options]
+        outputs[func.__name__] = {json.dumps(value): func(value) for value in values}
+    return outputs
+
+def export_snapshot(folder='snapshot'):
+    client = server.test_client()
+    index = client.get('/').get_data(as_text=True)
+    os.makedirs(folder, exist_ok=True)
+
+    # Scripts, stylesheets and the favicon are saved under the same paths the page requests them from
+    for path in set(re.findall(r'(?:src|href)="(/[^"]+)"', index)):
+        target = os.path.join(folder, path.split('?')[0].lstrip('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(client.get(path).data)
+    shutil.copytree(app.config.assets_folder, os.path.join(folder, 'assets'), dirs_exist_ok=True)
+
+    # External stylesheets such as the Bootstrap theme are bundled too, so the page doesn't depend on a CDN
+    os.makedirs(os.path.join(folder, 'external'), exist_ok=True)
+    for stylesheet in app.config.external_stylesheets:
+        url = stylesheet['href'] if isinstance(stylesheet, dict) else stylesheet
+        path = '/external/' + url.split('?')[0].rsplit('/', 1)[-1]
+        r = requests.get(url)
+        r.raise_for_status()
+        with open(os.path.join(folder, path.lstrip('/')), 'wb') as f:
+            f.write(r.content)
+        index = index.replace(f'href="{url}"', f'href="{path}"')
+
+    callback_outputs = precompute_callback_outputs()
+    dependencies = client.get('/_dash-dependencies').get_json()
+    for dependency in dependencies:
+        function_name = inspect.unwrap(app.callback_map[dependency['output']]['callback']).__name__
+        dependency['clientside_function'] = {'namespace': snapshot_namespace, 'function_name': function_name}
+
+    with open(os.path.join(folder, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(index.replace('<head>', '<head>\n' + snapshot_fetch_shim, 1))
+    with open(os.path.join(folder, '_dash-layout.json'), 'wb') as f:
+        f.write(client.get('/_dash-layout').data)
+    with open(os.path.join(folder, '_dash-dependencies.json'), 'w', encoding='utf-8') as f:
+        json.dump(dependencies, f)
+    with open(os.path.join(folder, 'snapshot.js'), 'w', encoding='utf-8') as f:
+        f.write(snapshot_lookup_template % (pio.json.to_json_plotly(callback_outputs), snapshot_namespace))
+    return folder
+'''========================================================================================'''
+
 #serve the dash app
 if __name__ == '__main__':
-     port = int(os.environ.get('PORT', 8050))  # Default to 8050 if PORT is not set
-     app.run_server(port=port, use_reloader=False)
+    if exporting:
+        # python index.py export [folder]
+        print(f"Static snapshot written to {export_snapshot(*sys.argv[2:3])}")
+    else:
+        port = int(os.environ.get('PORT', 8050))  # Default to 8050 if PORT is not set
+        app.run_server(port=port, use_reloader=False)
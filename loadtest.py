@@ -0,0 +1,73 @@
+# ----- CALLBACK COALESCING LOAD TEST -----
+# Starts the dashboard on a local threaded server, fires a burst of identical callback requests
+# (the same ones a shared link to the Racial Breakdown tab triggers) and checks that they were
+# served by fewer computations than requests. The first burst runs without the result cache, so
+# only in-flight coalescing can save work; the second runs with it.
+#
+#   python loadtest.py [requests] [threads]
+import sys
+import json
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server
+
+import index
+
+def callback_request(output, component_id, value, outputs):
+    return {
+        'output': output,
+        'outputs': outputs,
+        'inputs': [{'id': component_id, 'property': 'value', 'value': value}],
+        'changedPropIds': [f'{component_id}.value'],
+        'state': []
+    }
+
+stats_outputs = [{'id': component_id, 'property': 'children'} for component_id in ['total-stops', 'search-rate', 'arrest-rate', 'hit-rate']]
+burst = [
+    callback_request('funnel-chart.figure', 'race-dropdown', None, {'id': 'funnel-chart', 'property': 'figure'}),
+    callback_request('funnel-chart.figure', 'race-dropdown', 'black', {'id': 'funnel-chart', 'property': 'figure'}),
+    callback_request('..total-stops.children...search-rate.children...arrest-rate.children...hit-rate.children..',
+                     'year-dropdown', 'All', stats_outputs)
+]
+
+def post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+def send_burst(base, total_requests, threads):
+    with urllib.request.urlopen(f'{base}/_callback-stats') as response:
+        before = json.load(response)
+    bodies = [burst[i % len(burst)] for i in range(total_requests)]
+    with ThreadPoolExecutor(threads) as pool:
+        statuses = list(pool.map(lambda body: post(f'{base}/_dash-update-component', body), bodies))
+    with urllib.request.urlopen(f'{base}/_callback-stats') as response:
+        after = json.load(response)
+    assert statuses == [200] * total_requests, 'some callback requests failed'
+    return {name: after[name] - before[name] for name in after}
+
+def run(total_requests=100, threads=32):
+    server = make_server('127.0.0.1', 0, index.server, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    ttl = index.coalesce.ttl
+    try:
+        # Without the result cache, only sharing in-flight computations can save any work
+        index.coalesce.ttl = 0
+        coalesced = send_burst(base, total_requests, threads)
+        index.coalesce.ttl = ttl
+        cached = send_burst(base, total_requests, threads)
+    finally:
+        index.coalesce.ttl = ttl
+        server.shutdown()
+
+    print(f"{total_requests} requests without the result cache: {coalesced}")
+    print(f"{total_requests} requests with a {ttl}s result cache: {cached}")
+    assert coalesced['coalesced'] > 0, 'concurrent identical requests were not coalesced'
+    assert coalesced['computed'] < total_requests, 'concurrent identical requests were all computed'
+    assert cached['computed'] < total_requests, 'identical requests were not served from the cache'
+    return coalesced, cached
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])